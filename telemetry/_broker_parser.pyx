@@ -0,0 +1,60 @@
+# cython: language_level=3
+'''optional compiled fast path for broker_throughput line parsing
+
+Build in place with `make fastparser` (needs cython); broker_throughput.py
+picks it up automatically if the extension is importable and falls back to
+the pure python parser otherwise.
+'''
+
+cdef enum:
+    ST_IDLE = 0
+    ST_BURST = 1
+    ST_ACK = 2
+
+cdef class LineParser:
+    '''state machine over burstnetsink trace lines, typed state in a struct
+
+    Mirrors ThroughputCounter.process_line; parsed records are handed back
+    to the counter via process_burst/process_ack.
+    '''
+    cdef int state
+    cdef long long identity
+    cdef long long msgid
+    cdef int nbytes
+    cdef object counter
+
+    def __init__(self, counter):
+        self.counter = counter
+        self.state = ST_IDLE
+        self.identity = -1
+        self.msgid = -1
+        self.nbytes = 0
+
+    cpdef feed(self, bytes line):
+        '''process one line of burstnetsink trace output'''
+        line = line.strip()
+        if line.startswith(b'received '):
+            self.state = ST_BURST
+            self.identity = -1
+            self.msgid = -1
+            self.nbytes = int(line[9:line.index(b' ', 9)])
+            return
+        if line.startswith(b'got ingestd ACK'):
+            self.state = ST_ACK
+            self.identity = -1
+            self.msgid = -1
+            return
+        if self.state == ST_IDLE:
+            return
+        if line.startswith(b'identity:'):
+            self.identity = int(line[9:], 16)
+        elif line.startswith(b'message id:'):
+            self.msgid = int(line[11:], 16)
+            if self.state == ST_ACK:
+                self.counter.process_ack(self.identity, self.msgid)
+                self.state = ST_IDLE
+        elif line.startswith(b'points:'):
+            if self.state == ST_BURST:
+                self.counter.process_burst(self.identity, self.msgid,
+                                           int(line[7:]))
+                self.state = ST_IDLE
@@ -1,4 +1,4 @@
-#!/usr/bin/env python 
+#!/usr/bin/env python3
 
 '''use burstnetsink to tap a broker's debug stream and output throughput info
 
@@ -8,9 +8,20 @@ e.g.:
 '''
 
 import sys
-from time import *
+from time import monotonic_ns, sleep
 import os
 import fcntl
+import re
+import select
+
+import numpy as np
+
+try:
+    # compiled fast path for the line parser (see _broker_parser.pyx);
+    # built with `make fastparser`, entirely optional
+    import _broker_parser
+except ImportError:
+    _broker_parser = None
 
 class TimeAware(object):
     '''simple timing aware mixin
@@ -19,19 +30,22 @@ class TimeAware(object):
     passed to the constructor in tick_handlers
     '''
     def __init__(self, ticklen=1, tick_handlers=[]):
-        self.last_tick = self.start_time = time()
+        self.last_tick = self.start_time = monotonic_ns()
         self.ticklen = ticklen
+        # tick bookkeeping runs on integer nanoseconds: int compares and
+        # adds, no float boxing per check, immune to wall-clock jumps
+        self.ticklen_ns = int(ticklen * 1000000000)
         self.tick_handlers = tick_handlers
         self.n_ticks = 0
         self.totalticktime = 0
     def check_for_tick_changed(self):
         '''run on_tick_change once for every ticklen seconds that has passed since last_tick
         '''
-        tnow = time()
-        while tnow - self.last_tick >= self.ticklen:
+        tnow = monotonic_ns()
+        while tnow - self.last_tick >= self.ticklen_ns:
             self.n_ticks += 1
             self.totalticktime += self.ticklen
-            self.last_tick += self.ticklen
+            self.last_tick += self.ticklen_ns
             self.on_tick_change()
     def on_tick_change(self):
         '''handler for a tick change
@@ -48,94 +62,266 @@ class TimeAware(object):
             self.check_for_tick_changed()
             sleep(sleep_time)
 
-class TimeHistogram(TimeAware):
-    '''implements a rolling histogram'''
-    def __init__(self, nbins, seconds_per_bin=1):
+# shared scratch for ordered-bin reads: the aggregator is single-threaded,
+# so every histogram can rotate its ring through the one temporary
+_scratch = np.empty(600, dtype=np.int64)
+
+def _scratch_for(n):
+    global _scratch
+    if _scratch.shape[0] < n:
+        _scratch = np.empty(n, dtype=np.int64)
+    return _scratch[:n]
+
+class HistogramBank(TimeAware):
+    '''a bank of rolling histograms sharing one tick clock
+
+    Bins are stored structure-of-arrays style as one (nhists, nbins) int64
+    ring with a shared current_bin, so each add pays for one tick check and
+    a bin rotation clears one contiguous column across every histogram.
+    '''
+    def __init__(self, nhists, nbins, seconds_per_bin=1):
         TimeAware.__init__(self, seconds_per_bin)
+        self.nhists = nhists
         self.nbins = nbins
-        self._bins = [0 for n in range(nbins)]
+        self._bins = np.zeros((nhists, nbins), dtype=np.int64)
+        # running grand totals plus the totals as of the moment each bin was
+        # opened; a window sum is then just the difference of two totals
+        self._cum = np.zeros(nhists, dtype=np.int64)
+        self._cum_at_tick = np.zeros((nhists, nbins), dtype=np.int64)
         self.current_bin = 0
     def on_tick_change(self):
         self.current_bin = (self.current_bin + 1) % self.nbins
-        self._bins[self.current_bin] = 0
-    def add(self, n=1):
-        '''add 'n' to the current histogram bin
+        self._cum_at_tick[:, self.current_bin] = self._cum
+        self._bins[:, self.current_bin] = 0
+    def check_for_tick_changed(self):
+        '''as TimeAware, but if we've been starved for longer than the ring
+        covers, every bin is stale: reset the whole ring in one pass
+        instead of rotating it bin by bin, elapsed/nbins times over
+        '''
+        elapsed = (monotonic_ns() - self.last_tick) // self.ticklen_ns
+        if elapsed < self.nbins:
+            TimeAware.check_for_tick_changed(self)
+            return
+        self._bins[:] = 0
+        self._cum_at_tick[:] = self._cum[:, None]
+        self.current_bin = (self.current_bin + elapsed) % self.nbins
+        self.last_tick += elapsed * self.ticklen_ns
+        self.n_ticks += elapsed
+        self.totalticktime += elapsed * self.ticklen
+    def add(self, idx, n=1):
+        '''add 'n' to histogram idx's current bin
         '''
         self.check_for_tick_changed()
-        self._bins[self.current_bin] += n
-    def sum(self, k=60):
-        '''return the total entries per second over the last k seconds
+        self._bins[idx, self.current_bin] += n
+        self._cum[idx] += n
+    def sum(self, idx, k=60):
+        '''return the total entries in histogram idx over the last k seconds
+
+        A pure read: the caller is responsible for ticking the clock first
+        (add() does, or call check_for_tick_changed() once per batch of
+        queries so they all see the same bin).
         '''
-        bins_to_check = k/self.ticklen
-        return sum(self.bins[-bins_to_check:])
-    def mean(self, k=60):
-        '''return the mean entries per second over the last k seconds
+        # explicit floor division: ticklen may be a float, and a float
+        # bins_to_check would silently break the ring index below
+        bins_to_check = int(k // self.ticklen)
+        if bins_to_check <= 0:
+            return 0
+        # everything added since the oldest bin in the window was opened
+        oldest = (self.current_bin - bins_to_check + 1) % self.nbins
+        return self._cum[idx] - self._cum_at_tick[idx, oldest]
+    def sums(self, idx, ks):
+        '''return histogram idx's totals over the last k seconds for every k in ks
+
+        All windows are answered from one indexing operation on the
+        cumulative totals, so querying N windows costs the same as one.
+        A pure read, like sum(): the caller ticks the clock.
+        '''
+        bins_to_check = (np.asarray(ks) // self.ticklen).astype(np.int64)
+        oldest = (self.current_bin - bins_to_check + 1) % self.nbins
+        return np.where(bins_to_check > 0,
+                        self._cum[idx] - self._cum_at_tick[idx, oldest], 0)
+    def mean(self, idx, k=60):
+        '''return histogram idx's mean entries per second over the last k seconds
         '''
         if self.totalticktime < k:
             k = self.totalticktime  # Only average over the time we've been running
-        bins_to_check = k/self.ticklen
-        return self.sum(k) / float(bins_to_check) if bins_to_check else 0
-    @property 
-    def bins(self):
-        '''get bins in time order, oldest to newest'''
+        bins_to_check = int(k // self.ticklen)
+        if bins_to_check <= 0:
+            return 0
+        # call the bank's sum explicitly: TimeHistogram overrides it with a
+        # single-histogram signature
+        return HistogramBank.sum(self, idx, k) / float(bins_to_check)
+    def means(self, idx, ks):
+        '''return histogram idx's mean entries per second for every k in ks
+        '''
+        # Only average over the time we've been running
+        ks = np.minimum(np.asarray(ks), self.totalticktime)
+        bins_to_check = (ks // self.ticklen).astype(np.int64)
+        return np.where(bins_to_check > 0,
+                        HistogramBank.sums(self, idx, ks)
+                        / np.maximum(bins_to_check, 1).astype(float), 0)
+    def copy_bins_ordered(self, idx, out=None):
+        '''copy histogram idx's bins, oldest to newest, into out
+
+        With no out argument the shared module scratch buffer is used, so
+        transient consumers never allocate; pass your own array to keep the
+        result across calls.
+        '''
         self.check_for_tick_changed()
-        return self._bins[self.current_bin+1:]+self._bins[:self.current_bin+1]
+        if out is None:
+            out = _scratch_for(self.nbins)
+        split = self.nbins - (self.current_bin + 1)
+        out[:split] = self._bins[idx, self.current_bin+1:]
+        out[split:] = self._bins[idx, :self.current_bin+1]
+        return out
+
+class TimeHistogram(HistogramBank):
+    '''implements a rolling histogram (a bank of one)'''
+    def __init__(self, nbins, seconds_per_bin=1):
+        HistogramBank.__init__(self, 1, nbins, seconds_per_bin)
+    def add(self, n=1):
+        HistogramBank.add(self, 0, n)
+    def sum(self, k=60):
+        return HistogramBank.sum(self, 0, k)
+    def sums(self, ks):
+        return HistogramBank.sums(self, 0, ks)
+    def mean(self, k=60):
+        return HistogramBank.mean(self, 0, k)
+    def means(self, ks):
+        return HistogramBank.means(self, 0, ks)
+    def copy_bins_ordered(self, out=None):
+        return HistogramBank.copy_bins_ordered(self, 0, out)
+
+# parser states: between records, inside a burst record, inside an ack record
+_ST_IDLE, _ST_BURST, _ST_ACK = 0, 1, 2
+
+# every line shape we care about, in one compiled pattern: a single scan
+# dispatches the line and captures its fields
+_LINE_RE = re.compile(rb'received (\d+) bytes'
+                      rb'|got ingestd ACK'
+                      rb'|(identity|message id|points):\s*(\S+)', re.ASCII)
+
+# indices of the counter's histograms in its shared bank
+POINTS, BURSTS, ACKED_BURSTS, LATENCIES, ACKS = range(5)
 
 class ThroughputCounter(object):
     def __init__(self, input_stream=sys.stdin):
         self.input_stream=input_stream
-
-        self.point_hist = TimeHistogram(600) 
-        self.burst_hist = TimeHistogram(600) 
-        self.acked_burst_hist = TimeHistogram(600) 
-        self.latency_hist = TimeHistogram(600) 
-        self.ack_hist = TimeHistogram(600) 
+        self._fd = input_stream.fileno()
+        self._buf = bytearray()
+
+        self.hists = HistogramBank(5, 600)
+        # log-binned latency distribution (HDR-style): bin b counts
+        # latencies whose microsecond value has bit_length b, i.e. the
+        # [2^(b-1), 2^b) us bracket. O(1) insert, ~0.5KB, gives percentiles
+        # which the per-second windows above cannot
+        self.latency_hdr = np.zeros(64, dtype=np.int64)
         self.outstanding_bursts = {}  # burstid -> start timestamp,points
-        self._reader_state = {}
+        # running total of points in outstanding_bursts, maintained on
+        # burst/ack so reporting never walks the dict
+        self._outstanding_points_total = 0
+        # parser state machine: what kind of record we're inside plus the
+        # fields seen so far, held as scalars rather than a per-record dict
+        self._state = _ST_IDLE
+        self._identity = -1
+        self._msgid = -1
+        self._bytes = 0
+        if _broker_parser is not None:
+            # shadow the method on the instance with the compiled parser
+            self.process_line = _broker_parser.LineParser(self).feed
+
+    def snapshot(self):
+        '''advance the histogram clock once for a consistent set of reads
+
+        The get_* methods below are pure reads; call this once per
+        reporting cycle so every window query in the cycle sees the same
+        current bin, instead of each query ticking the clock itself.
+        '''
+        self.hists.check_for_tick_changed()
 
     def get_outstanding(self,last_n_seconds=[10,60]):
-        total_burst_counts = map(self.point_hist.sum, last_n_seconds)
-        total_ack_counts = map(self.ack_hist.sum, last_n_seconds)
-        return [nbursts-nacks for nbursts,nacks in zip(total_burst_counts,total_ack_counts)]
+        ks = np.asarray(last_n_seconds, dtype=np.int64)
+        return (self.hists.sums(POINTS, ks) - self.hists.sums(ACKS, ks)).tolist()
     def get_total_outstanding_points(self):
-        return sum(points for timestamp,points in self.outstanding_bursts.itervalues())
+        return self._outstanding_points_total
+    def expire_stale_bursts(self, max_age=600):
+        '''drop outstanding bursts older than max_age seconds
+
+        Bursts whose acks were lost would otherwise pin the dict (and the
+        outstanding count) forever. The dict is insertion-ordered, so the
+        stale entries are all at the front and expiry is O(n_expired).
+        '''
+        cutoff = monotonic_ns() - max_age * 1000000000
+        while self.outstanding_bursts:
+            msgtag = next(iter(self.outstanding_bursts))
+            timestamp, points = self.outstanding_bursts[msgtag]
+            if timestamp >= cutoff:
+                break
+            del self.outstanding_bursts[msgtag]
+            self._outstanding_points_total -= points
     def get_points_per_seconds(self,over_seconds=[600,60,1]):
-        return map(self.point_hist.mean, over_seconds)
+        return self.hists.means(POINTS, over_seconds)
     def get_total_bursts(self,over_seconds=[600,60,1]):
-        return map(self.burst_hist.mean, over_seconds)
+        return self.hists.means(BURSTS, over_seconds)
     def get_acks_per_second(self,over_seconds=[600,60,1]):
-        return map(self.ack_hist.mean, over_seconds)
+        return self.hists.means(ACKS, over_seconds)
     def get_average_latencies(self,over_seconds=[600,60,1]):
-        burst_counts = map(self.acked_burst_hist.sum, over_seconds)
-        latency_sums = map(self.latency_hist.sum, over_seconds)
-        return [latencysum/float(nbursts) if nbursts > 0 else 0 for latencysum,nbursts in zip(latency_sums,burst_counts)]
-
-    def process_burst(self, data):
-        if not all(k in data for k in ('identity','message id','points')): 
-            print >> sys.stderr, 'malformed databurst info. ignoring'
+        burst_counts = self.hists.sums(ACKED_BURSTS, over_seconds)
+        latency_sums = self.hists.sums(LATENCIES, over_seconds)  # microseconds
+        return np.where(burst_counts > 0,
+                        latency_sums / (1e6 * np.maximum(burst_counts, 1)), 0)
+    def get_latency_percentiles(self,percentiles=(50,95,99)):
+        '''estimate latency percentiles (in seconds) over the whole run
+
+        Estimates come from the log-binned distribution, so each is only
+        accurate to its power-of-two bracket (returned as the bracket
+        midpoint).
+        '''
+        total = self.latency_hdr.sum()
+        if not total:
+            return [0.0 for p in percentiles]
+        ranks = np.cumsum(self.latency_hdr)
+        out = []
+        for p in percentiles:
+            b = int(np.searchsorted(ranks, p/100.0 * total))
+            out.append(1.5 * 2**(b-1) / 1e6 if b else 0.0)
+        return out
+
+    def process_burst(self, identity, msgid, points):
+        if identity < 0 or msgid < 0:
+            print('malformed databurst info. ignoring', file=sys.stderr)
             return
-        msgtag = data['identity']+data['message id']
-        points = int(data['points'])
-        timestamp = time()
+        # key on a single int rather than a concatenated hex string; hashing
+        # a machine word is far cheaper than allocating+hashing a new str
+        msgtag = (identity << 32) | msgid
+        timestamp = monotonic_ns()
+        old = self.outstanding_bursts.get(msgtag)
+        if old is not None:
+            # resent burst: don't count its points twice
+            self._outstanding_points_total -= old[1]
         self.outstanding_bursts[msgtag] = timestamp,points
-        self.burst_hist.add(1)
-        self.point_hist.add(points)
+        self._outstanding_points_total += points
+        self.hists.add(BURSTS, 1)
+        self.hists.add(POINTS, points)
 
-    def process_ack(self, data):
-        if not all(k in data for k in ('identity','message id')): 
-            print >> sys.stderr, 'malformed ack info. ignoring'
+    def process_ack(self, identity, msgid):
+        if identity < 0 or msgid < 0:
+            print('malformed ack info. ignoring', file=sys.stderr)
             return
 
-        msgtag = data['identity']+data['message id']
+        msgtag = (identity << 32) | msgid
         if msgtag not in self.outstanding_bursts:
             # got ack we didn't see the burst for. ignoring it.
             return
 
         burst_timestamp,points = self.outstanding_bursts.pop(msgtag)
-        latency = time() - burst_timestamp
-        self.ack_hist.add(points)
-        self.acked_burst_hist.add(1)
-        self.latency_hist.add(latency)
+        self._outstanding_points_total -= points
+        # fixed-point microseconds: keeps the histogram in int64 end to end
+        latency_us = (monotonic_ns() - burst_timestamp) // 1000
+        self.hists.add(ACKS, points)
+        self.hists.add(ACKED_BURSTS, 1)
+        self.hists.add(LATENCIES, latency_us)
+        self.latency_hdr[latency_us.bit_length()] += 1
 
     def process_line(self, line):
         '''process a line of burstnetsink trace output
@@ -151,31 +337,55 @@ class ThroughputCounter(object):
                 uncompressed:       61133 bytes
                 points:             405
         '''
-        line = line.strip()
-        state = self._reader_state
-        k,tok,v = line.partition(':')
-        if tok == ':':
-            state[k] = v.strip()
-            if state.get('reading') == 'burst' and k == 'points':
-                self.process_burst(state)
-                self_reader_state = state = {}
-            if state.get('reading') == 'ack' and k == 'message id':
-                self.process_ack(state)
-                self_reader_state = state = {}
-        if 'received ' in line: 
-            self._reader_state = {'reading':'burst', 'bytes': int(line.split()[1])}
-        elif 'got ingestd ACK' in line:
-            self._reader_state = {'reading':'ack'}
+        # one regex match dispatches the line and captures its fields;
+        # the state machine then routes them into scalars
+        m = _LINE_RE.match(line.strip())
+        if m is None:
+            return
+        nbytes, key, value = m.groups()
+        if key is not None:
+            if self._state == _ST_IDLE:
+                return
+            if key == b'identity':
+                self._identity = int(value, 16)
+            elif key == b'message id':
+                self._msgid = int(value, 16)
+                if self._state == _ST_ACK:
+                    self.process_ack(self._identity, self._msgid)
+                    self._state = _ST_IDLE
+            elif self._state == _ST_BURST:  # points
+                self.process_burst(self._identity, self._msgid, int(value))
+                self._state = _ST_IDLE
+        elif nbytes is not None:
+            self._state = _ST_BURST
+            self._identity = self._msgid = -1
+            self._bytes = int(nbytes)
+        else:
+            self._state = _ST_ACK
+            self._identity = self._msgid = -1
 
     def process_lines_from_stream(self):
         '''process any lines from our streams that are available to read'''
+        # drain the non-blocking fd in big chunks rather than per-line
+        # readline() calls, then split on newlines with bytes.find (memchr)
         while True:
             try:
-                l = self.input_stream.readline()
-                self.process_line(l)
-            except IOError:
+                chunk = os.read(self._fd, 65536)
+            except BlockingIOError:
                 # Nothing left to read at the moment
-                return
+                break
+            if not chunk:
+                break
+            self._buf.extend(chunk)
+        start = 0
+        while True:
+            i = self._buf.find(b'\n', start)
+            if i < 0:
+                break
+            self.process_line(bytes(self._buf[start:i]))
+            start = i + 1
+        if start:
+            del self._buf[:start]
 
 
 class ThroughputPrinter(object):
@@ -184,8 +394,14 @@ class ThroughputPrinter(object):
         self.outstream = outstream
         self.avgtimes = avgtimes
         self.lines_printed = 0
+        # one format string for the whole row, built once
+        colbreak = " " * 3
+        self._row_fmt = colbreak.join([" %9.2f" * len(avgtimes)] * 3)
+        self._row_fmt += colbreak + "%10d\n"
+        # the header is a pure function of avgtimes, so build it once too
+        self._header = self._build_header()
 
-    def print_header(self):
+    def _build_header(self):
         colbreak = " " * 3
         header = '#'
         header += "mean points per second".center(29) + colbreak
@@ -201,35 +417,33 @@ class ThroughputPrinter(object):
         header += "".join(("(%dsec)" % secs).rjust(10) for secs in self.avgtimes)
         header += colbreak + "points".rjust(10) + '\n'
 
-        header += '# ' + '-'*28 + colbreak + '-'*30 + colbreak + '-'*30 
+        header += '# ' + '-'*28 + colbreak + '-'*30 + colbreak + '-'*30
         header += colbreak + '-'*10 + '\n'
+        return header
 
-        self.outstream.write(header)
+    def print_header(self):
+        self.outstream.write(self._header)
         self.outstream.flush()
 
     def print_throughput(self):
+        self.counter.snapshot()
         bursts_per_second = self.counter.get_points_per_seconds(self.avgtimes)
         acks_per_second = self.counter.get_acks_per_second(self.avgtimes)
         mean_latencies = self.counter.get_average_latencies(self.avgtimes)
         outstanding_points = self.counter.get_total_outstanding_points()
 
-        # RENDER ALL THE THINGS!
-        out = ""
-
-        colbreak = " " * 3
-        out += "".join((" %9.2f" % b for b in bursts_per_second))
-        out += colbreak
-        out += "".join((" %9.2f" % b for b in acks_per_second))
-        out += colbreak
-        out += "".join((" %9.2f" % b for b in mean_latencies))
-        out += colbreak
-        out += "%10d" % outstanding_points + '\n'
+        # RENDER ALL THE THINGS! (one format call, one allocation)
+        out = self._row_fmt % (tuple(bursts_per_second)
+                               + tuple(acks_per_second)
+                               + tuple(mean_latencies)
+                               + (outstanding_points,))
 
         if self.lines_printed % 20 == 0:
             self.print_header()
 
+        # no explicit flush: the stream is line-buffered (see __main__), so
+        # the newline gets the row out without a forced syscall per second
         self.outstream.write(out)
-        self.outstream.flush()
         self.lines_printed += 1
 
 
@@ -240,13 +454,24 @@ if __name__ == '__main__':
     fl = fcntl.fcntl(fd, fcntl.F_GETFL)
     fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
 
+    # Line-buffer stdout so complete rows are visible immediately even
+    # when piped, without an explicit flush per row
+    sys.stdout.reconfigure(line_buffering=True)
+
     reader = ThroughputCounter(sys.stdin)
     writer = ThroughputPrinter(reader, sys.stdout)
-    
-    # Run an event loop to process outstanding input every second
-    # and then output the processed data
 
-    event_loop = TimeAware(1, [ reader.process_lines_from_stream,
-                                writer.print_throughput ])
-    event_loop.run_forever()
+    # Block in select() until stdin has data or the next tick is due,
+    # rather than waking 10x a second to poll. Input is handled as soon
+    # as it arrives; the printer still fires once per tick.
+
+    event_loop = TimeAware(1, [ writer.print_throughput,
+                                reader.expire_stale_bursts ])
+    while True:
+        timeout = max(0, event_loop.last_tick + event_loop.ticklen_ns
+                         - monotonic_ns()) / 1e9
+        readable,_,_ = select.select([sys.stdin], [], [], timeout)
+        if readable:
+            reader.process_lines_from_stream()
+        event_loop.check_for_tick_changed()
 